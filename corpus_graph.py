@@ -0,0 +1,459 @@
+"""
+Corpus-level keyword extraction over a single global co-occurrence
+graph, built map-reduce style so that the corpus never has to fit in
+memory at once.
+
+    map    - Every worker turns a shard of documents into a partial edge
+             count table over shard-local word ids, spilling sorted runs
+             to disk whenever the table grows past `max_pairs`.
+    remap  - The shard vocabularies are merged into a global vocabulary
+             and every run is rewritten in global word ids and re-sorted.
+    merge  - The sorted runs are merged block by block into a single
+             on-disk edge table, summing the counts of repeated edges,
+             in several passes when there are too many runs to open at
+             once.
+    rank   - The weighted graph is ranked with the weighted PageRank score
+             of `udax.textrank.rank_pagerank`, streaming the edges from
+             disk on every iteration.
+
+Like `gen_graph` in `old/kw.py`, words are linked to the words within
+`cofact` positions of themselves. The graph is undirected and the weight
+of an edge is the number of times its two words co-occurred.
+"""
+import os
+from itertools import islice
+from multiprocessing import Pool
+from pathlib import Path
+
+import numpy as np
+from nltk import pos_tag
+from nltk.tokenize import word_tokenize
+
+
+# Pairs of word ids are packed into a single 64-bit key `a << 32 | b` with
+# `a <= b`, so the undirected edges of the graph sort and merge as plain
+# integers.
+ID_BITS = 32
+ID_MASK = (1 << ID_BITS) - 1
+
+
+def preprocess_keywords(text):
+    """
+    Tokenizes `text` and keeps only the nouns and adjectives, following
+    the suggestion of the paper (see `is_noun_or_adj` in `old/kw.py`).
+    """
+    return [
+        word for word, pos in pos_tag(word_tokenize(text))
+        if pos.startswith("NN") or pos.startswith("JJ") ]
+
+
+# --- Edge Tables ------------------------------------------------------
+def pack_pairs(A, B):
+    return (np.minimum(A, B) << ID_BITS) | np.maximum(A, B)
+
+
+def unpack_pairs(keys):
+    return keys >> ID_BITS, keys & ID_MASK
+
+
+def cooccurrence_pairs(ids, cofact=2):
+    """
+    The packed pair of every two words of the id array `ids` at most
+    `cofact` positions apart. A word occurring next to itself does not
+    link to itself.
+    """
+    parts = []
+    for gap in range(1, min(cofact, len(ids) - 1) + 1):
+        A, B = ids[:-gap], ids[gap:]
+        distinct = A != B
+        parts.append(pack_pairs(A[distinct], B[distinct]))
+    if len(parts) == 0:
+        return np.empty(0, dtype=np.int64)
+    return np.concatenate(parts)
+
+
+def reduce_pairs(keys, counts):
+    """
+    Sorts the packed pairs `keys` and sums the `counts` of the repeated
+    ones.
+
+    :return
+        (<ndarray:distinct sorted keys>, <ndarray:summed counts>)
+    """
+    order = np.argsort(keys, kind="stable")
+    keys = keys[order]
+    counts = counts[order]
+    if len(keys) == 0:
+        return keys, counts
+    starts = np.flatnonzero(np.concatenate(([ True ], keys[1:] != keys[:-1])))
+    return keys[starts], np.add.reduceat(counts, starts)
+
+
+# Runs are stored like the merged edge table, as raw int64 arrays in
+# `<path>.keys` and `<path>.counts`, so that merges can stream into them.
+def _save_run(path, keys, counts):
+    keys.astype(np.int64, copy=False).tofile(f"{path}.keys")
+    counts.astype(np.int64, copy=False).tofile(f"{path}.counts")
+    return path
+
+
+def _load_run(path, mmap_mode=None):
+    if mmap_mode is None:
+        return (
+            np.fromfile(f"{path}.keys", dtype=np.int64),
+            np.fromfile(f"{path}.counts", dtype=np.int64))
+    if os.path.getsize(f"{path}.keys") == 0: # cannot map an empty file
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    return (
+        np.memmap(f"{path}.keys", dtype=np.int64, mode=mmap_mode),
+        np.memmap(f"{path}.counts", dtype=np.int64, mode=mmap_mode))
+
+
+def _remove_run(path):
+    os.remove(f"{path}.keys")
+    os.remove(f"{path}.counts")
+
+
+# --- Map --------------------------------------------------------------
+def map_shard(task):
+    """
+    Builds the partial edge count table of a shard of documents with
+    shard-local word ids. Runs in a worker process.
+
+    :return
+        (<str:vocabulary path>, <list:run paths>)
+    """
+    shard, documents, workdir, preprocess, cofact, max_pairs = task
+    vocab = {}
+    buffered = []
+    buffered_size = 0
+    runs = []
+
+    def _flush():
+        nonlocal buffered, buffered_size
+        keys = np.concatenate(buffered)
+        keys, counts = reduce_pairs(keys, np.ones(len(keys), dtype=np.int64))
+        path = os.path.join(workdir, f"map-{shard}-{len(runs)}")
+        runs.append(_save_run(path, keys, counts))
+        buffered = []
+        buffered_size = 0
+
+    for document in documents:
+        words = preprocess(document)
+        ids = np.fromiter(
+            (vocab.setdefault(x, len(vocab)) for x in words),
+            dtype=np.int64, count=len(words))
+        pairs = cooccurrence_pairs(ids, cofact)
+        if len(pairs) > 0:
+            buffered.append(pairs)
+            buffered_size += len(pairs)
+        if buffered_size >= max_pairs:
+            _flush()
+    if buffered_size > 0:
+        _flush()
+
+    # The words are stored in order of their local ids.
+    vocab_path = os.path.join(workdir, f"map-{shard}.vocab")
+    with open(vocab_path, mode="w", encoding="utf-8") as fout:
+        fout.write('\n'.join(vocab.keys()))
+    return vocab_path, runs
+
+
+def _shards(documents, shard_size):
+    documents = iter(documents)
+    while True:
+        shard = list(islice(documents, shard_size))
+        if len(shard) == 0:
+            return
+        yield shard
+
+
+# --- Remap ------------------------------------------------------------
+def merge_vocabularies(vocab_paths):
+    """
+    Merges the shard vocabularies into a global one.
+
+    :return
+        (<list:global words>, <list:ndarray local to global id lookups>)
+    """
+    words = []
+    ids = {}
+    lookups = []
+    for path in vocab_paths:
+        with open(path, mode="r", encoding="utf-8") as fin:
+            content = fin.read()
+        local = content.split('\n') if len(content) > 0 else []
+        lookup = np.empty(len(local), dtype=np.int64)
+        for i, word in enumerate(local):
+            if word not in ids:
+                ids[word] = len(words)
+                words.append(word)
+            lookup[i] = ids[word]
+        lookups.append(lookup)
+    if len(words) > ID_MASK:
+        raise ValueError(f"Vocabulary of {len(words)} words exceeds {ID_BITS}-bit ids")
+    return words, lookups
+
+
+def remap_run(task):
+    """
+    Rewrites a map run in global word ids, sorted and reduced again
+    since the order of the pairs changes. Runs in a worker process.
+    """
+    path, lookup, out_path = task
+    keys, counts = _load_run(path)
+    A, B = unpack_pairs(keys)
+    keys, counts = reduce_pairs(pack_pairs(lookup[A], lookup[B]), counts)
+    _remove_run(path)
+    return _save_run(out_path, keys, counts)
+
+
+# --- Merge ------------------------------------------------------------
+def _merge_pass(runs, fkeys, fcounts, block):
+    """
+    Merges the sorted `runs` into the open files `fkeys` and `fcounts`,
+    holding at most `block` entries of all runs in memory at once.
+
+    :return
+        <int:number of edges written>
+    """
+    if len(runs) == 0:
+        return 0
+    sources = [ _load_run(x, mmap_mode="r") for x in runs ]
+    chunk = max(1, block // len(sources))
+    offsets = [ 0 ] * len(sources)
+    edges = 0
+    while True:
+        active = [
+            i for i, (keys, _) in enumerate(sources)
+            if offsets[i] < len(keys) ]
+        if len(active) == 0:
+            break
+
+        # Every entry up to the smallest last key of the current chunks
+        # is final: the runs hold distinct keys, so any later entry of
+        # any run is strictly larger.
+        bound = min([
+            sources[i][0][min(offsets[i] + chunk, len(sources[i][0])) - 1]
+            for i in active ])
+        key_parts = []
+        count_parts = []
+        for i in active:
+            keys, counts = sources[i]
+            start = offsets[i]
+            end = min(start + chunk, len(keys))
+            stop = start + int(np.searchsorted(keys[start:end], bound, side="right"))
+            key_parts.append(np.asarray(keys[start:stop]))
+            count_parts.append(np.asarray(counts[start:stop]))
+            offsets[i] = stop
+
+        keys, counts = reduce_pairs(
+            np.concatenate(key_parts), np.concatenate(count_parts))
+        keys.tofile(fkeys)
+        counts.tofile(fcounts)
+        edges += len(keys)
+    return edges
+
+
+def merge_runs(runs, keys_output, counts_output, block=1 << 20, fan_in=64):
+    """
+    Merges the sorted runs into a single sorted edge table, summing the
+    counts of repeated edges. The table is written as raw int64 arrays
+    to `keys_output` and `counts_output`.
+
+    At most `fan_in` runs are open at once: while there are more, groups
+    of `fan_in` runs are first merged into intermediate runs next to
+    `keys_output`, which are removed once merged in turn. At most `block`
+    entries are held in memory at once, shared by the open runs.
+
+    :return
+        <int:number of edges>
+    """
+    if fan_in < 2:
+        raise ValueError("fan_in must be >= 2")
+    workdir = os.path.dirname(keys_output)
+    runs = list(runs)
+    intermediate = set()
+    level = 0
+    while len(runs) > fan_in:
+        merged = []
+        for i in range(0, len(runs), fan_in):
+            path = os.path.join(workdir, f"merge-{level}-{len(merged)}")
+            with open(f"{path}.keys", mode="wb") as fkeys, \
+                 open(f"{path}.counts", mode="wb") as fcounts:
+                _merge_pass(runs[i:i+fan_in], fkeys, fcounts, block)
+            merged.append(path)
+        for run in runs:
+            if run in intermediate:
+                _remove_run(run)
+        intermediate = set(merged)
+        runs = merged
+        level += 1
+
+    with open(keys_output, mode="wb") as fkeys, open(counts_output, mode="wb") as fcounts:
+        edges = _merge_pass(runs, fkeys, fcounts, block)
+    for run in runs:
+        if run in intermediate:
+            _remove_run(run)
+    return edges
+
+
+# --- Interface --------------------------------------------------------
+class CorpusGraph:
+    """
+    The merged global co-occurrence graph stored in `workdir`:
+
+        words.txt  - The words of the graph, one per line, in id order.
+        edges.keys - The sorted, packed word id pairs of the edges.
+        edges.counts - The co-occurrence count of every edge.
+    """
+
+    def __init__(self, workdir):
+        self.workdir = Path(workdir)
+        with self.workdir.joinpath("words.txt").open(mode="r", encoding="utf-8") as fin:
+            content = fin.read()
+        self.words = content.split('\n') if len(content) > 0 else []
+
+    def edges(self):
+        """
+        The memory-mapped (keys, counts) arrays of the edges.
+        """
+        keys_path = self.workdir.joinpath("edges.keys")
+        counts_path = self.workdir.joinpath("edges.counts")
+        if keys_path.stat().st_size == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        return (
+            np.memmap(keys_path, dtype=np.int64, mode="r"),
+            np.memmap(counts_path, dtype=np.int64, mode="r"))
+
+    def _edge_blocks(self, block):
+        keys, counts = self.edges()
+        for start in range(0, len(keys), block):
+            A, B = unpack_pairs(np.asarray(keys[start:start+block]))
+            yield A, B, np.asarray(counts[start:start+block], dtype=np.float64)
+
+    def rank(self, damp=0.85, convthresh=1e-4, max_iterations=100, block=1 << 22):
+        """
+        Ranks the words with the weighted PageRank score of
+        `udax.textrank.rank_pagerank`, with every edge in both directions,
+        until no score changes by more than `convthresh`. Only `block`
+        edges are read into memory at a time.
+
+        :return
+            (<list:(word, score) sorted by descending score>, <int:iterations>)
+        """
+        size = len(self.words)
+        out_weights = np.zeros(size)
+        for A, B, W in self._edge_blocks(block):
+            out_weights += np.bincount(A, weights=W, minlength=size)
+            out_weights += np.bincount(B, weights=W, minlength=size)
+
+        scores = np.full(size, 1 / size if size > 0 else 0.0)
+        iterations = 0
+        while iterations < max_iterations:
+            iterations += 1
+            # Nodes with a zero weight sum do not contribute, as in
+            # `udax.textrank.rank_pagerank`.
+            contrib = np.divide(
+                scores, out_weights,
+                out=np.zeros(size), where=out_weights > 0)
+            incoming = np.zeros(size)
+            for A, B, W in self._edge_blocks(block):
+                incoming += np.bincount(B, weights=W * contrib[A], minlength=size)
+                incoming += np.bincount(A, weights=W * contrib[B], minlength=size)
+            n_scores = (1 - damp) + damp * incoming
+            err = np.max(np.abs(n_scores - scores)) if size > 0 else 0.0
+            scores = n_scores
+            if err < convthresh:
+                break
+
+        order = np.argsort(-scores, kind="stable")
+        return [ (self.words[i], float(scores[i])) for i in order ], iterations
+
+
+def build_graph(
+    documents,
+    workdir,
+    preprocess=preprocess_keywords,
+    cofact=2,
+    shard_size=10000,
+    max_pairs=1 << 22,
+    processes=None):
+    """
+    Builds the global co-occurrence graph of `documents` in `workdir`.
+
+    :param documents
+        An iterable of document strings, consumed lazily one wave of
+        shards at a time.
+
+    :param preprocess
+        A picklable function turning a document into its list of words,
+        which must not contain newlines.
+
+    :param max_pairs
+        The number of co-occurrences a map worker buffers before spilling
+        a sorted run to disk.
+
+    :param processes
+        The number of worker processes, defaults to the number of cores.
+
+    :return
+        A `CorpusGraph`.
+    """
+    workdir = Path(workdir)
+    workdir.mkdir(parents=True, exist_ok=True)
+    processes = processes or os.cpu_count() or 1
+
+    with Pool(processes) as pool:
+        # map, `processes` shards at a time to bound the documents held in
+        # memory.
+        mapped = []
+        shards = enumerate(_shards(documents, shard_size))
+        while True:
+            wave = [
+                (i, shard, str(workdir), preprocess, cofact, max_pairs)
+                for i, shard in islice(shards, processes) ]
+            if len(wave) == 0:
+                break
+            mapped.extend(pool.map(map_shard, wave))
+            print(f"Mapped {len(mapped)} shards.")
+
+        # remap
+        words, lookups = merge_vocabularies([ x[0] for x in mapped ])
+        tasks = []
+        for (vocab_path, runs), lookup in zip(mapped, lookups):
+            os.remove(vocab_path)
+            for run in runs:
+                out_path = os.path.join(
+                    os.path.dirname(run),
+                    os.path.basename(run).replace("map-", "sorted-"))
+                tasks.append((run, lookup, out_path))
+        runs = pool.map(remap_run, tasks)
+
+    # merge
+    edges = merge_runs(
+        runs, workdir.joinpath("edges.keys"), workdir.joinpath("edges.counts"))
+    for run in runs:
+        _remove_run(run)
+    with workdir.joinpath("words.txt").open(mode="w", encoding="utf-8") as fout:
+        fout.write('\n'.join(words))
+    print(f"Merged {len(runs)} runs into {edges} edges over {len(words)} words.")
+
+    return CorpusGraph(workdir)
+
+
+if __name__ == "__main__":
+    corpus = Path("data/duc2004/raw")
+    workdir = Path("data/duc2004/corpus-graph")
+
+    documents = (
+        file.read_text(encoding="latin")
+        for batch in sorted(corpus.iterdir())
+        for file in sorted(batch.iterdir()) )
+    graph = build_graph(documents, workdir, shard_size=50)
+    table, iterations = graph.rank()
+
+    print(f"Reached conversion after {iterations} iterations.")
+    print("Top keywords in the corpus:")
+    for i, (word, score) in enumerate(table[:25]):
+        print(f"{i+1}. {word}")
@@ -6,6 +6,8 @@ from nltk.tokenize import sent_tokenize, word_tokenize
 from udax.rouge import Task, Score, LCSMode
 import udax.rouge as rouge
 
+import rouge_fast
+
 
 def rouge_report_to_data_string(report):
     score = report.score
@@ -19,13 +21,7 @@ uday_summaries = Path("ext/DUCRes2/")
 ref_summaries = Path("data/duc2004/rouge/task2/")
 
 # collect the reference documents
-ref_docs = {}
-for refsum in ref_summaries.iterdir():
-    doc_id = refsum.name.split('.')[0]
-    if doc_id in ref_docs:
-        ref_docs[doc_id].append(refsum)
-    else:
-        ref_docs[doc_id] = [ refsum ]
+ref_docs = rouge_fast.group_references(ref_summaries)
 
 
 # evaluate uday summaries
@@ -51,19 +47,19 @@ for syssum in uday_summaries.iterdir():
             summary_report[f"Rouge-{i}"] = rouge_report_to_data_string(report_n)
         
         # ROUGE-WLCS
-        report_wlcs = rouge.wlcs(task, sent_tokenize, word_tokenize, lcsmode=LCSMode.SUMMARY)
+        report_wlcs = rouge_fast.wlcs(task, sent_tokenize, word_tokenize, lcsmode=LCSMode.SUMMARY)
         summary_report["Rouge-WLCS"] = rouge_report_to_data_string(report_wlcs)
 
         # ROUGE-LCS
-        report_lcs = rouge.lcs(task, sent_tokenize, word_tokenize, lcsmode=LCSMode.SUMMARY)
+        report_lcs = rouge_fast.lcs(task, sent_tokenize, word_tokenize, lcsmode=LCSMode.SUMMARY)
         summary_report["Rouge-LCS"] = rouge_report_to_data_string(report_lcs)
 
         # ROUGE-SU
-        report_su = rouge.su(task, word_tokenize)
+        report_su = rouge_fast.su(task, word_tokenize)
         summary_report["Rouge-SU-2"] = rouge_report_to_data_string(report_su)
 
         # ROUGE-S
-        report_s = rouge.s(task, word_tokenize)
+        report_s = rouge_fast.s(task, word_tokenize)
         summary_report["Rouge-S-2"] = rouge_report_to_data_string(report_s)
 
         all_reports[doc_id] = summary_report
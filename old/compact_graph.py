@@ -0,0 +1,403 @@
+"""
+A memory-compact replacement for the list-of-lists graphs built by
+`gen_graph` in `kw.py` and `ks.py`.
+
+The legacy graphs store every node as a list such as
+
+    [word, score, [inward indices], [outward indices]]
+
+which costs a list per node, two more per adjacency, and a boxed int
+(or float) per link. `CompactGraph` keeps the scores in a single
+`array('d')` and, once frozen, all links in compressed sparse rows of
+`array('i')` neighbor indices and `array('d')` weights, the latter
+only when some link is not of unit weight. Nodes are
+accessed through small `__slots__` views that can be indexed like the
+legacy lists, so `rank`, `rankw` and `rank_sample` work unchanged.
+"""
+import random
+import time
+import tracemalloc
+from abc import ABC, abstractmethod
+from array import array
+
+import numpy as np
+
+
+class CompactGraph:
+    """
+    A graph whose links are made bidirectional like the legacy graphs:
+    linking `i` and `j` adds `j` to the neighbors of `i` and `i` to the
+    neighbors of `j`, unless they are already linked, in which case the
+    first weight is kept. The inward and outward links of a node are
+    therefore the same.
+
+    Links are buffered until `freeze()` packs them into sparse rows,
+    neighbors keeping the order in which they were first linked. Every
+    `chunk` new links, the buffer drops those already linked, so that it
+    holds little more than the distinct links.
+    """
+
+    __slots__ = (
+        "labels", "scores", "defscore", "chunk",
+        "_sources", "_targets", "_weights", "_keys", "_distinct",
+        "offsets", "degrees", "neighbors", "weights", "_weight_sums")
+
+    def __init__(self, defscore=1, chunk=1 << 16):
+        self.labels = []
+        self.scores = array('d')
+        self.defscore = defscore
+        self.chunk = chunk
+        self._sources = array('i')
+        self._targets = array('i')
+        self._weights = None
+        # The sorted keys of the first `_distinct` buffered links, which
+        # are all distinct.
+        self._keys = np.empty(0, dtype=np.int64)
+        self._distinct = 0
+        self.offsets = None
+        self.degrees = None
+        self.neighbors = None
+        self.weights = None
+        self._weight_sums = None
+
+    def __len__(self):
+        return len(self.labels)
+
+    def add_node(self, label):
+        index = len(self.labels)
+        self.labels.append(label)
+        self.scores.append(self.defscore)
+        return index
+
+    def link(self, i, j, weight=1):
+        if self.offsets is not None:
+            raise RuntimeError("Cannot link the nodes of a frozen graph")
+        self._sources.append(i)
+        self._targets.append(j)
+        # Weights are only stored once a link is not of unit weight.
+        if self._weights is not None or weight != 1:
+            if self._weights is None:
+                self._weights = array('d', [ 1 ]) * (len(self._sources) - 1)
+            self._weights.append(weight)
+        if len(self._sources) - self._distinct >= self.chunk:
+            self._deduplicate()
+
+    def _deduplicate(self):
+        """
+        Drops the buffered links made after `_distinct` that are already
+        linked, keeping the first of them in order.
+        """
+        start = self._distinct
+        sources = np.frombuffer(self._sources, dtype=np.int32)[start:]
+        targets = np.frombuffer(self._targets, dtype=np.int32)[start:]
+
+        # A link adds both directions at once, so the first link between
+        # two nodes in either direction is the one that counts.
+        keys = np.minimum(sources, targets).astype(np.int64) << 32
+        keys |= np.maximum(sources, targets)
+        keys, first = np.unique(keys, return_index=True)
+        positions = np.searchsorted(self._keys, keys)
+        found = positions < len(self._keys)
+        found[found] = self._keys[positions[found]] == keys[found]
+        new = ~found
+        self._keys = np.insert(self._keys, positions[new], keys[new])
+        del keys, positions, found
+
+        kept = np.sort(first[new])
+        del first, new
+        end = start + len(kept)
+        sources[:len(kept)] = sources[kept]
+        targets[:len(kept)] = targets[kept]
+        del sources, targets
+        del self._sources[end:]
+        del self._targets[end:]
+        if self._weights is not None:
+            weights = np.frombuffer(self._weights, dtype=np.float64)[start:]
+            weights[:len(kept)] = weights[kept]
+            del weights
+            del self._weights[end:]
+        self._distinct = end
+
+    def freeze(self):
+        """
+        Packs the buffered links into sparse rows: the neighbors of node
+        `i` are `neighbors[offsets[i]:offsets[i+1]]` with the weights in
+        the same range of `weights`, and `degrees[i]` of them.
+        """
+        if self.offsets is not None:
+            return self
+        self._deduplicate()
+        self._keys = None
+        size = len(self)
+        sources = np.frombuffer(self._sources, dtype=np.int32)
+        targets = np.frombuffer(self._targets, dtype=np.int32)
+
+        # Expand every link into both directions and group them by source
+        # keeping the link order. The two directions of a link are next to
+        # each other, so the neighbor of entry `k` is entry `k ^ 1`. A node
+        # linked to itself is linked only once: its second entry gets the
+        # source `size`, which sorts last and is then dropped.
+        both = np.empty(2 * len(sources), dtype=np.int32)
+        both[0::2] = sources
+        both[1::2] = targets
+        del sources, targets
+        self._sources = None
+        self._targets = None
+        loops = both[0::2] == both[1::2]
+        both[1::2][loops] = size
+        count = len(both) - int(np.count_nonzero(loops))
+        has_loops = count < len(both)
+        del loops
+        order = np.argsort(both, kind="stable")[:count]
+        counts = np.bincount(both, minlength=size + 1)[:size]
+
+        # Gather straight into the arrays instead of copying into them.
+        order ^= 1
+        self.neighbors = array('i', [ 0 ]) * count
+        neighbors = np.frombuffer(self.neighbors, dtype=np.int32)
+        np.take(both, order, out=neighbors)
+        if has_loops: # the neighbor of a node linked to itself is itself
+            loops = neighbors == size
+            neighbors[loops] = both[order[loops] ^ 1]
+            del loops
+        del both, neighbors
+        if self._weights is not None:
+            order >>= 1 # the index of the link of every entry
+            self.weights = array('d', [ 0 ]) * count
+            np.take(
+                np.frombuffer(self._weights, dtype=np.float64), order,
+                out=np.frombuffer(self.weights, dtype=np.float64))
+            self._weights = None
+        del order
+
+        self.offsets = array('q', [ 0 ])
+        self.offsets.extend(np.cumsum(counts).tolist())
+        self.degrees = array('i', counts.astype(np.int32).tolist())
+        return self
+
+    def neighbors_of(self, i):
+        return memoryview(self.neighbors)[self.offsets[i]:self.offsets[i+1]]
+
+    def weights_of(self, i):
+        start, end = self.offsets[i], self.offsets[i+1]
+        if self.weights is None: # every link is of unit weight
+            return memoryview(array('d', [ 1 ]) * (end - start))
+        return memoryview(self.weights)[start:end]
+
+    def weight_sums(self):
+        """
+        The sum of the weights of the links of every node, summed like
+        the legacy `sum(Jwout)`.
+        """
+        if self._weight_sums is None:
+            self._weight_sums = array('d', [
+                sum(self.weights_of(i)) for i in range(len(self)) ])
+        return self._weight_sums
+
+    def view(self, node_type):
+        """
+        A sequence of `node_type` views over the frozen graph, shaped
+        like the list returned by the legacy `gen_graph`.
+        """
+        return GraphView(self.freeze(), node_type)
+
+
+class GraphView:
+    """
+    A read-only sequence of node views over a `CompactGraph`.
+    """
+
+    __slots__ = ("graph", "node_type")
+
+    def __init__(self, graph, node_type):
+        self.graph = graph
+        self.node_type = node_type
+
+    def __len__(self):
+        return len(self.graph)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self.graph)
+        if not 0 <= i < len(self.graph):
+            raise IndexError("graph index out of range")
+        return self.node_type(self.graph, i)
+
+    def __iter__(self):
+        for i in range(len(self.graph)):
+            yield self.node_type(self.graph, i)
+
+    def to_lists(self):
+        """
+        Materializes the legacy list-of-lists graph.
+        """
+        return [ x.to_list() for x in self ]
+
+
+class NodeView(ABC):
+    """
+    A view of a single node of a `CompactGraph` that can be indexed,
+    unpacked and have its score assigned like the legacy node lists.
+    Subclasses lay out the fields of the node in `fields()`.
+    """
+
+    __slots__ = ("_graph", "_index")
+
+    def __init__(self, graph, index):
+        self._graph = graph
+        self._index = index
+
+    @property
+    def label(self):
+        return self._graph.labels[self._index]
+
+    @property
+    def score(self):
+        return self._graph.scores[self._index]
+
+    @score.setter
+    def score(self, value):
+        self._graph.scores[self._index] = value
+
+    @property
+    def neighbors(self):
+        return self._graph.neighbors_of(self._index)
+
+    @property
+    def weights(self):
+        return self._graph.weights_of(self._index)
+
+    @abstractmethod
+    def fields(self):
+        """
+        The fields of the node, in the order of the legacy node lists.
+        """
+
+    def __len__(self):
+        return len(self.fields())
+
+    def __getitem__(self, k):
+        return self.fields()[k]
+
+    def __setitem__(self, k, value):
+        if k != 1:
+            raise TypeError("Only the score of a node can be assigned")
+        self.score = value
+
+    def __iter__(self):
+        return iter(self.fields())
+
+    def to_list(self):
+        return [ list(x) if isinstance(x, memoryview) else x for x in self.fields() ]
+
+    def __repr__(self):
+        return repr(self.to_list())
+
+
+class WordNode(NodeView):
+    """
+    The node layout of `kw.gen_graph`:
+
+        T[0] - A unique word in the graph.
+        T[1] - The current score of the word.
+        T[2] - The list of inward directed indices.
+        T[3] - The list of outward directed indices.
+    """
+
+    __slots__ = ()
+
+    def fields(self):
+        neighbors = self.neighbors
+        return (self.label, self.score, neighbors, neighbors)
+
+
+class SentenceNode(NodeView):
+    """
+    The node layout of `ks.gen_graph`:
+
+        T[0] - sentence index in the sample
+        T[1] - the score of the sentence
+        T[2] - list of inward connections represented by sentence indices.
+        T[3] - list of inward weights corresponding to some connections.
+        T[4] - list of outward connections represented by sentence indices.
+        T[5] - list of outward weights corresponding to some connections.
+    """
+
+    __slots__ = ()
+
+    def fields(self):
+        neighbors = self.neighbors
+        weights = self.weights
+        return (self.label, self.score, neighbors, weights, neighbors, weights)
+
+
+# --- Benchmarks -------------------------------------------------------
+def _bench_words(count, vocab_size, seed=0):
+    rng = random.Random(seed)
+    return [ f"w{x}" for x in rng.choices(range(vocab_size), k=count) ]
+
+
+def _bench_build(words, cofact=2):
+    # The linking of `kw.gen_graph`, without its filtering.
+    map = {}
+    graph = CompactGraph()
+    for word in words:
+        if word not in map:
+            map[word] = graph.add_node(word)
+    for i, word in enumerate(words):
+        for j in range(max(0, i - cofact), min(len(words), i + cofact + 1)):
+            if j != i:
+                graph.link(map[word], map[words[j]])
+    return graph.view(WordNode)
+
+
+def _bench_build_lists(words, cofact=2):
+    # The legacy list-of-lists `kw.gen_graph`, without its filtering.
+    map = {}
+    graph = []
+    for word in words:
+        if word not in map:
+            map[word] = len(graph)
+            graph.append([ word, 1, [], [] ])
+    for i, word in enumerate(words):
+        for j in range(max(0, i - cofact), min(len(words), i + cofact + 1)):
+            if j != i:
+                I, J = map[word], map[words[j]]
+                _, _, Iin, Iout = graph[I]
+                _, _, Jin, Jout = graph[J]
+                if J not in Iin:
+                    Iin.append(J)
+                if J not in Iout:
+                    Iout.append(J)
+                if I not in Jin:
+                    Jin.append(I)
+                if I not in Jout:
+                    Jout.append(I)
+    return graph
+
+
+def _measure(f):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = f()
+    elapsed = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, current, peak, elapsed
+
+
+def BENCH_graph(count=500000, vocab_size=100000):
+    words = _bench_words(count, vocab_size)
+
+    print(f"Benchmarking graphs of {count} words over {vocab_size} distinct words")
+    view, current, peak, elapsed = _measure(lambda: _bench_build(words))
+    print("%-8s retained %8.1f MiB, peak %8.1f MiB, %6.2fs" % (
+        "compact", current / 2**20, peak / 2**20, elapsed))
+
+    lists, current, peak, elapsed = _measure(lambda: _bench_build_lists(words))
+    print("%-8s retained %8.1f MiB, peak %8.1f MiB, %6.2fs" % (
+        "lists", current / 2**20, peak / 2**20, elapsed))
+
+
+if __name__ == "__main__":
+    BENCH_graph()
@@ -8,6 +8,8 @@ from nltk.tokenize import word_tokenize
 from nltk.corpus import stopwords
 from pathlib import Path
 
+from compact_graph import CompactGraph, GraphView, SentenceNode
+
 
 useless_words = set(stopwords.words("english"))
 
@@ -60,53 +62,42 @@ def gen_graph(sample, defscore=1):
         T[3] - list of inward weights corresponding to some connections.
         T[4] - list of outward connections represented by sentence indices.
         T[5] - list of outward weights corresponding to some connections.
-    """
-    graph = []
-
-    def _link_sentences(i, j, weight):
-        nonlocal graph
-
-        _, _, Icin, Iwin, Icout, Iwout = graph[i]
-        _, _, Jcin, Jwin, Jcout, Jwout = graph[j]
 
-        if j not in Icin:
-            Icin.append(j)
-            Iwin.append(weight)
-        if j not in Icout:
-            Icout.append(j)
-            Iwout.append(weight)
-
-        if i not in Jcin:
-            Jcin.append(i)
-            Jwin.append(weight)
-        if i not in Jcout:
-            Jcout.append(i)
-            Jwout.append(weight)
+    The list is a `GraphView` of `SentenceNode` over a `CompactGraph`,
+    only the score of a node may be assigned.
+    """
+    graph = CompactGraph(defscore)
 
     for i in range(len(sample)):
-        graph.append([i, defscore, [], [], [], []])
+        graph.add_node(i)
 
     for i in range(len(sample)):
         i_sent = sample[i]
         for j in range(len(sample)):
             j_sent = sample[j]
-            _link_sentences(i, j, similarity(i_sent, j_sent))
+            graph.link(i, j, similarity(i_sent, j_sent))
     
-    return graph
+    return graph.view(SentenceNode)
 
 
 def rankw(G, i, damp=0.85, visited=None):
     """
     An implementation of the weighted score function as described in the
     paper. The structure expected of the graph G is described by `gen_graph`
-    above.
+    above, whose compact arrays are read directly.
     """
-    _, _, Lcin, Lwin, _, _ = G[i]
-
     sumr = 0
-    for j, w in zip(Lcin, Lwin):
-        _, Jscore, _, _, Jcout, Jwout = G[j]
-        sumr += Jscore * w / sum(Jwout)
+    if isinstance(G, GraphView):
+        graph = G.graph
+        scores = graph.scores
+        weight_sums = graph.weight_sums()
+        for j, w in zip(graph.neighbors_of(i), graph.weights_of(i)):
+            sumr += scores[j] * w / weight_sums[j]
+    else:
+        _, _, Lcin, Lwin, _, _ = G[i]
+        for j, w in zip(Lcin, Lwin):
+            _, Jscore, _, _, Jcout, Jwout = G[j]
+            sumr += Jscore * w / sum(Jwout)
     return (1 - damp) + damp * sumr
 
 
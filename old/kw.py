@@ -16,6 +16,8 @@ from nltk.tokenize import word_tokenize
 from nltk.corpus import stopwords
 from pathlib import Path
 
+from compact_graph import CompactGraph, GraphView, WordNode
+
 
 useless_words = set(stopwords.words("english"))
 
@@ -86,9 +88,12 @@ def gen_graph(words, defscore=1, cofact=2):
     
     The dict is a mapping of all of the unique words to their index
     in the list pseudo-graph.
+
+    The list is a `GraphView` of `WordNode` over a `CompactGraph`, only
+    the score of a node may be assigned.
     """
     map = {}
-    graph = []
+    graph = CompactGraph(defscore)
 
     def _push_word(word):
         nonlocal map, graph
@@ -96,37 +101,20 @@ def gen_graph(words, defscore=1, cofact=2):
         if word in map:
             return map[word]
         
-        index = len(graph)
+        index = graph.add_node(word)
         map[word] = index
-        graph.append([word, defscore, [], []])
         return index
-    
-    def _link_words(i, j): # i - index of the parent word, j - index of the child word
-        nonlocal map, graph
-
-        _, _, Iin, Iout = graph[i]
-        _, _, Jin, Jout = graph[j]
-
-        # this will effectively create an undirected graph, simulated
-        # by bidirection.
-        if j not in Iin:
-            Iin.append(j)
-        if j not in Iout:
-            Iout.append(j)
-
-        if i not in Jin:
-            Jin.append(i)
-        if i not in Jout:
-            Jout.append(i)
 
     for i, word in enumerate(words):
         main_i = _push_word(word)
         proxies = gather_proxy(words, i, radius=cofact)
         for proxy in proxies:
             proxy_i = _push_word(proxy)
-            _link_words(main_i, proxy_i)
+            # this will effectively create an undirected graph, simulated
+            # by bidirection.
+            graph.link(main_i, proxy_i)
     
-    return map, graph
+    return map, graph.view(WordNode)
 
 
 def rank(G, i, damp=0.85, visited=None):
@@ -139,13 +127,22 @@ def rank(G, i, damp=0.85, visited=None):
         T[1] - The current score of the word.
         T[2] - The list of inward directed indices.
         T[3] - The list of outward directed indices.
-    """
-    _, _, Lin, _ = G[i]
 
+    The compact arrays of a graph returned by `gen_graph` are read
+    directly.
+    """
     sum = 0
-    for j in Lin:
-        _, Jscore, _, Jout = G[j]
-        sum += Jscore / len(Jout)
+    if isinstance(G, GraphView):
+        graph = G.graph
+        degrees = graph.degrees
+        scores = graph.scores
+        for j in graph.neighbors_of(i):
+            sum += scores[j] / degrees[j]
+    else:
+        _, _, Lin, _ = G[i]
+        for j in Lin:
+            _, Jscore, _, Jout = G[j]
+            sum += Jscore / len(Jout)
     return (1 - damp) + damp * sum
 
 
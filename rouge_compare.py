@@ -0,0 +1,268 @@
+"""
+Side-by-side ROUGE evaluation of several summarization systems against
+the same DUC 2004 reference summaries.
+
+The references of every batch are scanned, tokenized and encoded once
+(along with their LCS bitsets, n-gram and skip-bigram tables and the
+jackknife subsets) and then shared by the summaries of every system,
+instead of each evaluation script redoing that work on its own.
+"""
+from pathlib import Path
+
+import numpy as np
+from nltk.tokenize import sent_tokenize, word_tokenize
+
+import udax.algorithm as algo
+from udax.rouge import Task, Score, LCSMode
+
+import rouge_fast
+
+
+class System:
+    """
+    A directory of system summaries, one file per batch. `batch_id_f`
+    maps the name of a summary file to the id of its batch.
+    """
+
+    def __init__(self, name, summaries, batch_id_f=lambda x: x):
+        self.name = name
+        self.summaries = summaries
+        self.batch_id_f = batch_id_f
+
+    def batches(self):
+        return { self.batch_id_f(x.name): x for x in self.summaries.iterdir() }
+
+
+class ReferenceSet:
+    """
+    The reference summaries of a single batch, encoded once with a
+    vocabulary shared by every candidate summary scored against them.
+    """
+
+    def __init__(self, batch_id, references, sent_tokenizer, word_tokenizer, sodm="<s>"):
+        self.batch_id = batch_id
+        self.references = references
+        self.sent_tokenizer = sent_tokenizer
+        self.word_tokenizer = word_tokenizer
+        self.vocab = rouge_fast.Vocabulary()
+        self.sodm = self.vocab.encode([ sodm ])[0]
+        self.documents = [
+            self.encode(x) for x in Task.autodocs(*references) ]
+
+        # Every subset of all but one reference for jackknifing.
+        indices = list(range(len(self.documents)))
+        self.subsets = list(algo.comb(indices, len(indices) - 1))
+
+    def encode(self, document):
+        return rouge_fast.EncodedDocument.from_document(
+            document, self.vocab, self.word_tokenizer, self.sent_tokenizer)
+
+    def jackknife(self, name, scores):
+        """
+        Combines the per-reference `scores` of a candidate into a single
+        jackknifed score, as `udax.rouge` does.
+        """
+        if len(scores) == 1:
+            return scores[0]
+        reports = [
+            rouge_fast.max_report(name, [ scores[i] for i in subset ])
+            for subset in self.subsets ]
+        return Score.average(scorelist=[ x.score for x in reports ])
+
+
+# --- Metrics ----------------------------------------------------------
+# Each metric takes a `ReferenceSet` and an encoded candidate and returns
+# the score of the candidate against every reference in the set.
+def rouge_lcs(refset, can):
+    return [
+        rouge_fast.wlcs_score(x, can, lcsmode=LCSMode.SUMMARY)
+        for x in refset.documents ]
+
+
+def rouge_su(refset, can):
+    return rouge_fast.skip_bigram_scores(refset.documents, can, refset.sodm)
+
+
+def rouge_s(refset, can):
+    return rouge_fast.skip_bigram_scores(refset.documents, can)
+
+
+def rouge_n(N):
+    def _rouge_n(refset, can):
+        return rouge_fast.ngram_scores(refset.documents, can, N)
+    return _rouge_n
+
+
+DEFAULT_METRICS = [
+    ("Rouge-LCS", rouge_lcs),
+    ("Rouge-SU-2", rouge_su),
+    ("Rouge-S-2", rouge_s),
+    *[ (f"Rouge-{i}", rouge_n(i)) for i in range(1, 10) ]
+]
+
+
+# --- Evaluation -------------------------------------------------------
+def evaluate(
+    models,
+    systems,
+    metrics=DEFAULT_METRICS,
+    sent_tokenizer=sent_tokenize,
+    word_tokenizer=word_tokenize):
+    """
+    Scores the summaries of every system in `systems` against the
+    references in `models`.
+
+    :return
+        A dict mapping the name of each system to a dict mapping each
+        batch id to a dict of metric name to jackknifed `Score`.
+    """
+    model_set = rouge_fast.group_references(models)
+    system_batches = [ (x.name, x.batches()) for x in systems ]
+    results = { x.name: {} for x in systems }
+
+    for batch_id in sorted(model_set):
+        candidates = [
+            (name, batches[batch_id])
+            for name, batches in system_batches
+            if batch_id in batches ]
+        if len(candidates) == 0:
+            continue
+
+        print(f"Evaluating {batch_id}")
+        refset = ReferenceSet(
+            batch_id, model_set[batch_id], sent_tokenizer, word_tokenizer)
+        for name, summary in candidates:
+            can = refset.encode(Task.autodocs(summary)[0])
+            results[name][batch_id] = {
+                metric: refset.jackknife(summary.name, metric_f(refset, can))
+                for metric, metric_f in metrics }
+    return results
+
+
+def write_report(system_results, model_set, output_file):
+    """
+    Writes the results of a single system in the format produced by
+    `textrank_eval.rouge_evaluation`, readable by `rouge_plot_all`.
+    """
+    with output_file.open(mode="w") as fout:
+        for batch_id, scores in system_results.items():
+            references = model_set[batch_id]
+            summary_report = {
+                "References": ','.join([ x.name for x in references ]),
+                "Reference-Count": str(len(references)),
+                "Config": "jackknife=True,beta=1",
+                **{ key: repr(value) for key, value in scores.items() },
+                "Average-F-Score": str(
+                    sum([ x.f_score for x in scores.values() ]) / len(scores))
+            }
+            fout.write(f"{batch_id} {len(summary_report)}\n")
+            for key, value in summary_report.items():
+                fout.write(f"{key} {value}\n")
+
+
+# --- Comparison -------------------------------------------------------
+def common_batches(results):
+    batch_sets = [ set(x) for x in results.values() ]
+    return sorted(set.intersection(*batch_sets)) if batch_sets else []
+
+
+def score_arrays(results, metric, batches):
+    """
+    A (recall, precision, f-score) array of shape (systems, batches)
+    for `metric`, the systems being in the order of `results`.
+    """
+    values = np.array([
+        [ x[b][metric].recall, x[b][metric].precision, x[b][metric].f_score ]
+        for x in results.values()
+        for b in batches ], dtype=np.float64).reshape(len(results), len(batches), 3)
+    return values[:, :, 0], values[:, :, 1], values[:, :, 2]
+
+
+def paired_statistics(A, B, trials=10000, seed=0):
+    """
+    Paired significance statistics of the per-batch scores `A` against
+    `B`: the mean difference, the paired t statistic, a two-sided p-value
+    from a sign-flipping randomization test and the wins/losses/ties.
+    """
+    diff = np.asarray(A, dtype=np.float64) - np.asarray(B, dtype=np.float64)
+    count = len(diff)
+    mean = diff.mean()
+    std = diff.std(ddof=1) if count > 1 else 0.0
+    t = mean / (std / np.sqrt(count)) if std > 0 else 0.0
+
+    rng = np.random.default_rng(seed)
+    signs = rng.choice((-1.0, 1.0), size=(trials, count))
+    permuted = np.abs((signs * diff).mean(axis=1))
+    p = (np.count_nonzero(permuted >= abs(mean) - 1e-12) + 1) / (trials + 1)
+
+    return {
+        "mean": mean,
+        "t": t,
+        "p": p,
+        "wins": int(np.count_nonzero(diff > 0)),
+        "losses": int(np.count_nonzero(diff < 0)),
+        "ties": int(np.count_nonzero(diff == 0))
+    }
+
+
+def comparison_table(results, metrics=DEFAULT_METRICS):
+    """
+    A markdown table of the average recall / precision / f-score of
+    every system for each metric over the batches scored for all of
+    them, followed by the paired statistics of every pair of systems.
+    """
+    names = list(results.keys())
+    batches = common_batches(results)
+    lines = [
+        f"Averages over {len(batches)} common batches (R / P / F)",
+        "",
+        " | ".join([ "Evaluation Method", *names ]),
+        " | ".join([ "-" * 17, *[ "-" * len(x) for x in names ] ]) ]
+    if len(batches) == 0:
+        lines.append("No common batches, nothing to compare.")
+        return '\n'.join(lines) + '\n'
+
+    for metric, _ in metrics:
+        recalls, precisions, f_scores = score_arrays(results, metric, batches)
+        R, P, F = recalls.mean(axis=1), precisions.mean(axis=1), f_scores.mean(axis=1)
+        lines.append(" | ".join([
+            "%-17s" % metric,
+            *[ "%.3f / %.3f / %.3f" % x for x in zip(R, P, F) ] ]))
+
+    for i, j in algo.comb(list(range(len(names))), 2):
+        lines.extend([
+            "",
+            f"Paired F-score differences, {names[i]} - {names[j]}",
+            "",
+            "Evaluation Method | Mean Diff | t | p (randomization) | W / L / T",
+            "----------------- | --------- | - | ------------------ | ---------" ])
+        for metric, _ in metrics:
+            _, _, f_scores = score_arrays(results, metric, batches)
+            stats = paired_statistics(f_scores[i], f_scores[j])
+            lines.append("%-17s | %+.4f | %.3f | %.4f | %d / %d / %d" % (
+                metric, stats["mean"], stats["t"], stats["p"],
+                stats["wins"], stats["losses"], stats["ties"]))
+    return '\n'.join(lines) + '\n'
+
+
+if __name__ == "__main__":
+    models = Path("data/duc2004/rouge/task2")
+    systems = [
+        System("TextRank", Path("data/duc2004/multidoc-concat-summary")),
+        # remove the 't' at the end of Uday's summary names
+        System("Uday", Path("ext/DUCRes2"), lambda x: x[:-1].upper())
+    ]
+    comparison_output = Path("data/duc2004/rouge/comparison.md")
+
+    results = evaluate(models, systems)
+    model_set = rouge_fast.group_references(models)
+    for name, system_results in results.items():
+        write_report(
+            system_results,
+            model_set,
+            Path(f"data/duc2004/rouge/compare-{name.lower()}.out"))
+
+    table = comparison_table(results)
+    with comparison_output.open(mode="w") as fout:
+        fout.write(table)
+    print(table)
@@ -0,0 +1,232 @@
+"""
+A staged version of `textrank_eval.generate_batched_concatenation_summaries`
+that overlaps the disk I/O of some batches with the tokenization and
+ranking of others:
+
+    read       - Reads the documents of a batch (asyncio, in threads).
+    preprocess - Tokenizes the batch into sentences and words (process pool).
+    rank       - Ranks the sentences with TextRank (process pool).
+    write      - Writes the summary of the batch (asyncio, in threads).
+
+The stages are connected by bounded queues, so a slow stage stalls the
+ones feeding it instead of letting batches pile up in memory. The
+throughput of every stage and the depth of its output queue are
+reported once all batches are done.
+"""
+import asyncio
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from nltk.tokenize import sent_tokenize, word_tokenize
+
+import udax.textrank as tr
+
+from textrank_eval import get_file_text, summary_sentences
+
+
+# Marks the end of the batches in a queue, one per consuming worker.
+_DONE = None
+
+
+class StageStats:
+
+    def __init__(self, name, workers=1):
+        self.name = name
+        self.workers = workers
+        self.items = 0
+        self.busy = 0
+        self.depth_total = 0
+        self.depth_samples = 0
+        self.depth_max = 0
+
+    def sample(self, queue):
+        depth = queue.qsize()
+        self.depth_total += depth
+        self.depth_samples += 1
+        self.depth_max = max(self.depth_max, depth)
+
+    def report(self, elapsed):
+        depth_avg = self.depth_total / self.depth_samples if self.depth_samples > 0 else 0
+        utilization = self.busy / (elapsed * self.workers) if elapsed > 0 else 0
+        return "%-10s %5d batches, %7.2f batches/s, %5.1f%% busy, queue depth avg %.2f max %d" % (
+            self.name,
+            self.items,
+            self.items / elapsed if elapsed > 0 else 0,
+            100 * utilization,
+            depth_avg,
+            self.depth_max)
+
+
+# --- Workers ----------------------------------------------------------
+def preprocess_batch(content, sent_tokenizer, word_tokenizer):
+    reference = sent_tokenizer(content)
+    return reference, [ word_tokenizer(x) for x in reference ]
+
+
+def rank_batch(reference, processed):
+    # `tr.summarize` tokenizes by itself, hand it the tokens computed by
+    # the preprocessing stage instead.
+    tokens = dict(zip(reference, processed))
+    graph, raw_table, ref_table = tr.summarize(
+        None,
+        lambda _: reference,
+        lambda x: tokens[x])
+    return summary_sentences(ref_table)
+
+
+# --- Stages -----------------------------------------------------------
+async def _read(batches, queue, stats):
+    for batch in batches.iterdir():
+        start = time.perf_counter()
+        content_array = await asyncio.gather(*[
+            asyncio.to_thread(get_file_text, file) for file in batch.iterdir() ])
+        stats.busy += time.perf_counter() - start
+
+        await queue.put((batch.name, ('\n'.join(content_array),)))
+        stats.items += 1
+        stats.sample(queue)
+
+
+async def _process(executor, func, inqueue, outqueue, stats, *extra):
+    loop = asyncio.get_running_loop()
+    while True:
+        item = await inqueue.get()
+        if item is _DONE:
+            return
+        batch_id, args = item
+
+        start = time.perf_counter()
+        result = await loop.run_in_executor(executor, func, *args, *extra)
+        stats.busy += time.perf_counter() - start
+
+        await outqueue.put((batch_id, result))
+        stats.items += 1
+        stats.sample(outqueue)
+
+
+async def _write(output, queue, stats):
+    while True:
+        item = await queue.get()
+        if item is _DONE:
+            return
+        batch_id, sentences = item
+
+        start = time.perf_counter()
+        await asyncio.to_thread(
+            output.joinpath(batch_id).write_text,
+            ''.join([ f"{x}\n" for x in sentences ]))
+        stats.busy += time.perf_counter() - start
+        stats.items += 1
+        print(f"Completed summary for batch {batch_id}.")
+
+
+async def _close(upstream, queue, consumers):
+    await asyncio.gather(*upstream)
+    for _ in range(consumers):
+        await queue.put(_DONE)
+
+
+async def _pipeline(
+    batches,
+    output,
+    preprocess_workers,
+    rank_workers,
+    queue_size,
+    sent_tokenizer,
+    word_tokenizer):
+    read_queue, preprocess_queue, rank_queue = [
+        asyncio.Queue(maxsize=queue_size) for _ in range(3) ]
+    stats = [
+        StageStats("read"),
+        StageStats("preprocess", preprocess_workers),
+        StageStats("rank", rank_workers),
+        StageStats("write") ]
+
+    with ProcessPoolExecutor(preprocess_workers) as preprocess_pool, \
+         ProcessPoolExecutor(rank_workers) as rank_pool:
+        reader = asyncio.create_task(_read(batches, read_queue, stats[0]))
+        preprocessors = [
+            asyncio.create_task(_process(
+                preprocess_pool, preprocess_batch,
+                read_queue, preprocess_queue, stats[1],
+                sent_tokenizer, word_tokenizer))
+            for _ in range(preprocess_workers) ]
+        rankers = [
+            asyncio.create_task(_process(
+                rank_pool, rank_batch,
+                preprocess_queue, rank_queue, stats[2]))
+            for _ in range(rank_workers) ]
+        writer = asyncio.create_task(_write(output, rank_queue, stats[3]))
+
+        tasks = [
+            reader, *preprocessors, *rankers, writer,
+            asyncio.create_task(_close([ reader ], read_queue, preprocess_workers)),
+            asyncio.create_task(_close(preprocessors, preprocess_queue, rank_workers)),
+            asyncio.create_task(_close(rankers, rank_queue, 1)) ]
+
+        # Stop every stage as soon as one fails rather than leaving the
+        # others blocked on their queues.
+        done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        for task in pending:
+            task.cancel()
+        for task in done:
+            task.result()
+    return stats
+
+
+def generate_batched_concatenation_summaries(
+    batches,
+    output,
+    preprocess_workers=None,
+    rank_workers=None,
+    queue_size=4,
+    sent_tokenizer=sent_tokenize,
+    word_tokenizer=word_tokenize):
+    """
+    Generates the same summaries as the function of the same name in
+    `textrank_eval` with the stages of every batch running concurrently.
+
+    :param preprocess_workers
+        The number of processes tokenizing batches, by default a quarter
+        of the cores.
+
+    :param rank_workers
+        The number of processes ranking batches, by default the rest of
+        the cores.
+
+    :param queue_size
+        The maximum number of batches waiting between two stages.
+
+    :return
+        The `StageStats` of every stage.
+    """
+    cores = os.cpu_count() or 1
+    if preprocess_workers is None:
+        preprocess_workers = max(1, cores // 4)
+    if rank_workers is None:
+        rank_workers = max(1, cores - preprocess_workers)
+
+    start = time.perf_counter()
+    stats = asyncio.run(_pipeline(
+        batches,
+        output,
+        preprocess_workers,
+        rank_workers,
+        queue_size,
+        sent_tokenizer,
+        word_tokenizer))
+    elapsed = time.perf_counter() - start
+
+    print(f"Pipeline completed in {elapsed:.2f}s.")
+    for stage in stats:
+        print(stage.report(elapsed))
+    return stats
+
+
+if __name__ == "__main__":
+    batches = Path("data/duc2004/raw")
+    summary_output = Path("data/duc2004/multidoc-concat-summary")
+
+    generate_batched_concatenation_summaries(batches, summary_output)
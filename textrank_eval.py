@@ -1,4 +1,6 @@
+import hashlib
 import os
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
 import matplotlib
@@ -12,13 +14,16 @@ import udax.rouge as rouge
 import udax.statistics as stat
 import udax.textrank as tr
 
+import rouge_fast
+
 
 # Around 655 character summaries to match model summaries
 APPROX_LENGTH_LIMIT = 655
 
 
 def get_file_text(file):
-    content = open(file, mode="r", encoding="latin").readlines()
+    with open(file, mode="r", encoding="latin") as fin:
+        content = fin.readlines()
     start = 0
     end = len(content)
     for i, e in enumerate(content):
@@ -27,10 +32,25 @@ def get_file_text(file):
         if "</TEXT>" == e.strip():
             end = i
             break
-    content.close()
     return ''.join(content[start:end])
 
 
+def summary_sentences(ref_table, limit=APPROX_LENGTH_LIMIT):
+    """
+    The top ranked sentences of a `tr.summarize` reference table, up to
+    the first one reaching `limit` characters in total.
+    """
+    sentences = []
+    length = 0
+    i = 0
+    while i < len(ref_table) and length < limit:
+        sentence = ref_table[i][1]
+        sentences.append(sentence)
+        length += len(sentence)
+        i += 1
+    return sentences
+
+
 def generate_batched_concatenation_summaries(batches, output):
     for batch in batches.iterdir():
         batch_id = batch.name
@@ -45,26 +65,15 @@ def generate_batched_concatenation_summaries(batches, output):
                 content,
                 sent_tokenize,
                 word_tokenize)
-            length = 0
-            i = 0
-            while i < len(ref_table) and length < APPROX_LENGTH_LIMIT:
-                sentence = ref_table[i][1]
+            for sentence in summary_sentences(ref_table):
                 fout.write(f"{sentence}\n")
-                length += len(sentence)
-                i += 1
         print(f"Completed summary for batch {batch_id}.")
 
 
 def rouge_evaluation(models, summaries, output_file):
     # Enumerate the different versions of models.
-    model_set = {}
-    for model in models.iterdir():
-        batch_id = model.name.split('.')[0]
-        if batch_id in model_set:
-            model_set[batch_id].append(model)
-        else:
-            model_set[batch_id] = [ model ]
-        
+    model_set = rouge_fast.group_references(models)
+
     # Evaluate the textrank summarizations.
     all_reports = {}
     for summary in summaries.iterdir():
@@ -93,7 +102,7 @@ def rouge_evaluation(models, summaries, output_file):
             # Rouge-S 
 
             report_lcs \
-                = rouge.lcs(
+                = rouge_fast.lcs(
                     task, 
                     sent_tokenize, 
                     word_tokenize, 
@@ -101,11 +110,11 @@ def rouge_evaluation(models, summaries, output_file):
             rouge_summary["Rouge-LCS"] = repr(report_lcs.score)
 
             report_su \
-                = rouge.su(task, word_tokenize)
+                = rouge_fast.su(task, word_tokenize)
             rouge_summary["Rouge-SU-2"] = repr(report_su.score)
 
             report_s \
-                = rouge.s(task, word_tokenize)
+                = rouge_fast.s(task, word_tokenize)
             rouge_summary["Rouge-S-2"] = repr(report_s.score)
 
             reports_n = []
@@ -174,13 +183,46 @@ def rouge_plot_single(
     plt.close(fig)
     
 
-def rouge_plot_all(
-    output, 
-    plots_output, 
-    summary_plot_output, 
-    total_average_output):
-
-    rouge_all_scores = {}
+def rouge_plot_digest(title, rouge_scores):
+    """
+    A digest of everything a plot rendered by `rouge_plot_single` depends
+    on, used to skip re-rendering unchanged plots.
+    """
+    digest = hashlib.sha256(title.encode("utf-8"))
+    for key, score in rouge_scores.items():
+        digest.update(f"{key} {repr(score)}\n".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def rouge_plot_cached(title, rouge_scores, output):
+    """
+    Renders the plot with `rouge_plot_single` unless it already exists
+    with the same digest stored alongside it in `<output>.sha256`.
+
+    Returns whether the plot was rendered.
+    """
+    digest = rouge_plot_digest(title, rouge_scores)
+    digest_file = output.with_name(f"{output.name}.sha256")
+    if output.exists() and digest_file.exists():
+        if digest_file.read_text().strip() == digest:
+            return False
+    rouge_plot_single(title, rouge_scores, output)
+    digest_file.write_text(digest)
+    return True
+
+
+def _init_plot_worker():
+    # Workers only write files, they never need an interactive backend.
+    matplotlib.use("Agg")
+
+
+def read_rouge_report(output):
+    """
+    Reads the ROUGE scores of every batch in a report written by
+    `rouge_evaluation` into a dict of batch id to a dict of metric
+    name to `Score`.
+    """
+    rouge_batch_scores = {}
     with output.open(mode="r") as fin:
         while True:
             ln = fin.readline()
@@ -193,28 +235,67 @@ def rouge_plot_all(
                 ln = fin.readline()
                 if ln.startswith("Rouge"):
                     key, value = ln.split()
-                    score = Score.from_string(value)
-                    if key in rouge_all_scores:
-                        rouge_all_scores[key].append(score)
-                    else:
-                        rouge_all_scores[key] = [ score ]
-                    rouge_scores[key] = score
-            rouge_plot_single(
-                f"ROUGE: TextRank Evaluation of {batch_id} Summary", 
-                rouge_scores, 
-                plots_output.joinpath(f"{batch_id}.png"))
-    
-    rouge_all_scores_averaged = {}
+                    rouge_scores[key] = Score.from_string(value)
+            rouge_batch_scores[batch_id] = rouge_scores
+    return rouge_batch_scores
+
+
+def rouge_average_all(rouge_batch_scores):
+    """
+    The average score of every metric over all of the batches that
+    have it, computed at once for all metrics.
+    """
+    metrics = []
+    for rouge_scores in rouge_batch_scores.values():
+        for key in rouge_scores:
+            if key not in metrics:
+                metrics.append(key)
+
+    values = np.full((len(rouge_batch_scores), len(metrics), 3), np.nan)
+    for i, rouge_scores in enumerate(rouge_batch_scores.values()):
+        for j, key in enumerate(metrics):
+            if key in rouge_scores:
+                score = rouge_scores[key]
+                values[i, j] = (score.recall, score.precision, score.f_score)
+    averages = np.nanmean(values, axis=0)
+
+    return {
+        key: Score(*[ float(x) for x in averages[j] ])
+        for j, key in enumerate(metrics) }
+
+
+def rouge_plot_all(
+    output, 
+    plots_output, 
+    summary_plot_output, 
+    total_average_output,
+    system="TextRank",
+    processes=None):
+
+    rouge_batch_scores = read_rouge_report(output)
+    rouge_all_scores_averaged = rouge_average_all(rouge_batch_scores)
     with total_average_output.open(mode="w") as fout:
-        for metric, scores in rouge_all_scores.items():
-            avg_score = Score.average(scorelist=scores)
-            rouge_all_scores_averaged[metric] = avg_score
+        for metric, avg_score in rouge_all_scores_averaged.items():
             fout.write(f"{metric} {repr(avg_score)}\n")
 
-    rouge_plot_single(
-        f"ROUGE: TextRank Average on DUC 2004",
-        rouge_all_scores_averaged,
-        summary_plot_output)
+    # Render the plots in parallel, skipping those whose scores have not
+    # changed since the last run.
+    with ProcessPoolExecutor(processes, initializer=_init_plot_worker) as pool:
+        futures = [
+            pool.submit(
+                rouge_plot_cached,
+                f"ROUGE: {system} Evaluation of {batch_id} Summary",
+                rouge_scores,
+                plots_output.joinpath(f"{batch_id}.png"))
+            for batch_id, rouge_scores in rouge_batch_scores.items() ]
+        futures.append(pool.submit(
+            rouge_plot_cached,
+            f"ROUGE: {system} Average on DUC 2004",
+            rouge_all_scores_averaged,
+            summary_plot_output))
+        rendered = sum([ x.result() for x in futures ])
+
+    print(f"Rendered {rendered} plots, {len(futures) - rendered} unchanged.")
 
 
 if __name__ == "__main__": 
@@ -232,6 +313,9 @@ if __name__ == "__main__":
     # within the batch.
     # generate_batched_concatenation_summaries(batches, summary_output)
 
+    # (`python summary_pipeline.py` generates the same summaries while
+    # overlapping the file I/O, tokenization and ranking of batches.)
+
     # Evaluate the resulting
     # rouge_evaluation(models, summary_output, rouge_output)
 